@@ -55,17 +55,28 @@ def module_import_error(module):
 # pylint: disable=wrong-import-position
 import os
 import sys
+# fast path for version requests (e.g. health checks), skips module imports
+if sys.argv[1:] in (['-V'], ['--version']):
+    print('{} v{}'.format(os.path.basename(sys.argv[0]), VER))
+    sys.exit(ExitCode.OK)
 try:
+    import importlib.util
     import paho.mqtt.client as mqtt
     import time
     import datetime
     import zoneinfo
     import signal
     import logging
+    import logging.handlers
+    import queue
+    import atexit
     import configargparse
     import urllib
     import re
-    from threading import get_ident, Thread, BoundedSemaphore
+    import select
+    import http.server
+    from threading import get_ident, Thread, Event
+    from collections import OrderedDict, deque
     from random import random
 except ImportError as err:
     module_import_error(err)
@@ -74,22 +85,26 @@ try:
     MODULE_SSL_AVAIL = True
 except ImportError:
     MODULE_SSL_AVAIL = False
-try:
-    import MySQLdb
-    MODULE_MYSQLDB_AVAIL = True
-except ImportError:
-    MODULE_MYSQLDB_AVAIL = False
-try:
-    import sqlite3
-    MODULE_SQLITE3_AVAIL = True
-except ImportError:
-    MODULE_SQLITE3_AVAIL = False
+# SQL driver modules are probed only, the selected one is
+# imported by sql_module_import()
+MySQLdb = None
+sqlite3 = None
+MODULE_MYSQLDB_AVAIL = importlib.util.find_spec('MySQLdb') is not None
+MODULE_SQLITE3_AVAIL = importlib.util.find_spec('_sqlite3') is not None
 # pylint: enable=wrong-import-position
 
 SCRIPTNAME = os.path.basename(sys.argv[0])
 SCRIPTPID = os.getpid()
+# log prefix and MQTT client id, built once
+SCRIPTPREFIX = '{}[{}] v{}'.format(SCRIPTNAME, SCRIPTPID, VER)
+MQTT_CLIENT_ID = '{}-{:d}'.format(SCRIPTNAME, SCRIPTPID)
 SQLTYPES = {'mysql':'MySQL', 'sqlite':'SQLite'}
 ARGS = {}
+LOGGER = logging.getLogger(SCRIPTNAME)
+LOG_LISTENER = None
+# verbose and debug level, set once by log_start()
+VERBOSE_LEVEL = 0
+DEBUG_LEVEL = 0
 DEFAULTS = {
     'configfile': None,
     'logfile': None,
@@ -108,6 +123,9 @@ DEFAULTS = {
     'mqtt-insecure': False,
     'mqtt-keepalive': 60,
     'mqtt-connect-timeout':500,
+    'mqtt-protocol': '3.1',
+    'mqtt-qos': 0,
+    'mqtt-shared-group': None,
 
     'sql-type': 'mysql' if MODULE_MYSQLDB_AVAIL else ('sqlite' if MODULE_SQLITE3_AVAIL else None),
     'sql-host': 'localhost',
@@ -116,17 +134,61 @@ DEFAULTS = {
     'sql-password': None,
     'sql-db': None,
     'sql-table': 'mqtt',
-    'sql-max-connection': 50,
+    'sql-batch-size': 256,
+    'sql-batch-delay': 0.05,
+    'sql-queue-size': 10000,
     'sql-connection-retry': 10,
     'sql-connection-retry-start-delay': 1,
     'sql-transaction-retry': 10,
-    'sql-timezone': 'UTC'
+    'sql-timezone': 'UTC',
+    'sql-coalesce': False,
+    'sql-write-on-change': False,
+    'sql-write-interval': 0,
+    'sql-journal-mode': 'WAL',
+    'sql-synchronous': 'NORMAL',
+
+    'metrics-port': None,
+    'metrics-host': 'localhost'
 }
 
 DEFAULT_PORT_MQTT = 1883
 DEFAULT_PORT_MQTTS = 8883
 DEFAULT_PORT_MYSQL = 3306
 
+# max payload bytes shown within message log
+LOG_PAYLOAD_MAX = 256
+
+MQTT_PROTOCOLS = {'3.1': mqtt.MQTTv31, '3.1.1': mqtt.MQTTv311, '5': mqtt.MQTTv5}
+MQTT_CONNECT_ATTEMPTS = 2
+MQTT_CONNECT_RETRY_DELAY = 0.5
+MQTT_RECONNECT_DELAY_MIN = 1
+MQTT_RECONNECT_DELAY_MAX = 128
+# delay range in seconds after an exception within the network loop
+MQTT_LOOP_ERROR_DELAY_MIN = 0.01
+MQTT_LOOP_ERROR_DELAY_MAX = 1.0
+# MQTT loop results handled by reconnect
+MQTT_RECONNECT_ERRORS = frozenset({mqtt.MQTT_ERR_CONN_LOST, mqtt.MQTT_ERR_NO_CONN})
+
+SQL_CONNECTION_RETRY_DELAY_MAX = 30
+# transaction retry delay range in seconds, doubled each retry
+SQL_TRANSACTION_RETRY_DELAY_MIN = 0.01
+SQL_TRANSACTION_RETRY_DELAY_MAX = 0.5
+# MySQL error codes: too many connections, lock wait timeout, deadlock,
+# server gone away, connection lost
+MYSQL_RETRY_ERRORS = frozenset({1040, 1205, 1213, 2006, 2013})
+MYSQL_RECONNECT_ERRORS = frozenset({2006, 2013})
+# max number of topics remembered by --sql-write-on-change
+SQL_LAST_WRITTEN_MAX = 100000
+SQLITE_JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+SQLITE_SYNCHRONOUS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+# seconds to wait for a database lock held by another program
+SQLITE_BUSY_TIMEOUT = 5.0
+# page cache size in KiB
+SQLITE_CACHE_SIZE = 8192
+
+# socket name: empty or absolute path without whitespace
+SOCKET_NAME = re.compile(r'(\/\S*)?')
+
 def parseargs():
     """
     Program argument parser
@@ -194,7 +256,7 @@ def parseargs():
         dest='mqtt_exclude_topic',
         nargs='*',
         default=DEFAULTS['mqtt-exclude-topic'],
-        help="optional: topic(s) to exclude (default {}).".format(DEFAULTS['mqtt-exclude-topic']))
+        help="optional: topic(s) to exclude, wildcards '+' and '#' allowed (default {}).".format(DEFAULTS['mqtt-exclude-topic']))
     mqtt_group.add_argument(
         '--mqtt-cafile',
         metavar='<cafile>',
@@ -238,6 +300,28 @@ def parseargs():
         type=int,
         default=DEFAULTS['mqtt-connect-timeout'],
         help="timeout for mqtt connection (default {})".format(DEFAULTS['mqtt-connect-timeout']))
+    mqtt_group.add_argument(
+        '--mqtt-protocol',
+        metavar='<version>',
+        dest='mqtt_protocol',
+        choices=list(MQTT_PROTOCOLS),
+        default=DEFAULTS['mqtt-protocol'],
+        help="MQTT protocol version {} (default '{}')".format(list(MQTT_PROTOCOLS), DEFAULTS['mqtt-protocol']))
+    mqtt_group.add_argument(
+        '--mqtt-qos',
+        metavar='<qos>',
+        dest='mqtt_qos',
+        type=int,
+        choices=[0, 1, 2],
+        default=DEFAULTS['mqtt-qos'],
+        help="QoS level used for topic subscription (default {})".format(DEFAULTS['mqtt-qos']))
+    mqtt_group.add_argument(
+        '--mqtt-shared-group',
+        metavar='<group>',
+        dest='mqtt_shared_group',
+        default=DEFAULTS['mqtt-shared-group'],
+        help="optional: subscribe topics as shared subscription '$share/<group>/<topic>', "
+        "instances using the same group share the messages (default {})".format(DEFAULTS['mqtt-shared-group']))
 
     sql_group = parser.add_argument_group('SQL Options')
     sql_choices = []
@@ -246,7 +330,7 @@ def parseargs():
     if MODULE_SQLITE3_AVAIL:
         sql_choices.append('sqlite')
     if len(sql_choices) == 0:
-        SignalHandler.exitus(ExitCode.MISSING_MODULE, 'Either module MySQLdb or sqlite must be installed')
+        SIG.exitus(ExitCode.MISSING_MODULE, 'Either module MySQLdb or sqlite must be installed')
 
     sql_group.add_argument(
         '--sql-type',
@@ -310,12 +394,27 @@ def parseargs():
     sql_group.add_argument('--sqltimezone', dest='sql_timezone', choices=tz_choices, help=configargparse.SUPPRESS)
 
     sql_group.add_argument(
-        '--sql-max-connection',
+        '--sql-batch-size',
+        metavar='<num>',
+        dest='sql_batch_size',
+        type=int,
+        default=DEFAULTS['sql-batch-size'],
+        help="maximum number of messages written within one transaction (default {})".format(DEFAULTS['sql-batch-size']))
+    sql_group.add_argument(
+        '--sql-batch-delay',
+        metavar='<sec>',
+        dest='sql_batch_delay',
+        type=float,
+        default=DEFAULTS['sql-batch-delay'],
+        help="maximum delay to collect messages for one transaction (default {})".format(DEFAULTS['sql-batch-delay']))
+    sql_group.add_argument(
+        '--sql-queue-size',
         metavar='<num>',
-        dest='sql_max_connection',
+        dest='sql_queue_size',
         type=int,
-        default=DEFAULTS['sql-max-connection'],
-        help="maximum number of simultaneous connections (default {})".format(DEFAULTS['sql-max-connection']))
+        default=DEFAULTS['sql-queue-size'],
+        help="maximum number of messages waiting to be written, the oldest are dropped if exceeded (default {})".format(DEFAULTS['sql-queue-size']))
+    sql_group.add_argument('--sql-max-connection', dest='sql_max_connection', type=int, help=configargparse.SUPPRESS)
     sql_group.add_argument('--sqlmaxconnection', dest='sql_max_connection', type=int, help=configargparse.SUPPRESS)
     sql_group.add_argument(
         '--sql-connection-retry',
@@ -330,7 +429,7 @@ def parseargs():
         dest='sql_connection_retry_start_delay',
         type=float,
         default=DEFAULTS['sql-connection-retry-start-delay'],
-        help="start delay between SQL reconnect retry (default {}), is doubled after each occurrence".format(DEFAULTS['sql-connection-retry-start-delay']))
+        help="start delay between SQL reconnect retry (default {}), is doubled after each occurrence up to {} sec".format(DEFAULTS['sql-connection-retry-start-delay'], SQL_CONNECTION_RETRY_DELAY_MAX))
     sql_group.add_argument(
         '--sql-transaction-retry',
         metavar='<num>',
@@ -338,6 +437,43 @@ def parseargs():
         type=int,
         default=DEFAULTS['sql-transaction-retry'],
         help="maximum number of SQL transaction retry on error (default {})".format(DEFAULTS['sql-transaction-retry']))
+    sql_group.add_argument(
+        '--sql-coalesce',
+        dest='sql_coalesce',
+        action='store_true',
+        default=DEFAULTS['sql-coalesce'],
+        help="write only the latest payload of a topic if several messages of this topic are within one batch (default {}), "
+        "note: skipped payloads will not appear in history".format(DEFAULTS['sql-coalesce']))
+    sql_group.add_argument(
+        '--sql-write-on-change',
+        dest='sql_write_on_change',
+        action='store_true',
+        default=DEFAULTS['sql-write-on-change'],
+        help="write a topic only if its payload has changed (default {}), "
+        "note: skipped payloads will not appear in history".format(DEFAULTS['sql-write-on-change']))
+    sql_group.add_argument(
+        '--sql-write-interval',
+        metavar='<s>',
+        dest='sql_write_interval',
+        type=float,
+        default=DEFAULTS['sql-write-interval'],
+        help="using --sql-write-on-change write unchanged payloads at least every <s> seconds, 0 = never (default {})".format(DEFAULTS['sql-write-interval']))
+    sql_group.add_argument(
+        '--sql-journal-mode',
+        metavar='<mode>',
+        dest='sql_journal_mode',
+        choices=SQLITE_JOURNAL_MODES,
+        type=str.upper,
+        default=DEFAULTS['sql-journal-mode'],
+        help="SQLite journal mode {} (default '{}')".format(SQLITE_JOURNAL_MODES, DEFAULTS['sql-journal-mode']))
+    sql_group.add_argument(
+        '--sql-synchronous',
+        metavar='<mode>',
+        dest='sql_synchronous',
+        choices=SQLITE_SYNCHRONOUS,
+        type=str.upper,
+        default=DEFAULTS['sql-synchronous'],
+        help="SQLite synchronous mode {}, use FULL for strict durability (default '{}')".format(SQLITE_SYNCHRONOUS, DEFAULTS['sql-synchronous']))
 
     logging_group = parser.add_argument_group('Informational')
     logging_group.add_argument(
@@ -356,6 +492,19 @@ def parseargs():
         dest='verbose',
         action='count',
         help='verbose output')
+    logging_group.add_argument(
+        '--metrics-port',
+        metavar='<port>',
+        dest='metrics_port',
+        type=int,
+        default=DEFAULTS['metrics-port'],
+        help="serve Prometheus metrics via HTTP on this port, disabled if not given (default {})".format(DEFAULTS['metrics-port']))
+    logging_group.add_argument(
+        '--metrics-host',
+        metavar='<host>',
+        dest='metrics_host',
+        default=DEFAULTS['metrics-host'],
+        help="metrics HTTP server listen address (default '{}')".format(DEFAULTS['metrics-host']))
     logging_group.add_argument(
         '-V', '--version',
         action='version',
@@ -363,6 +512,24 @@ def parseargs():
 
     return parser.parse_args()
 
+def sql_module_import(sql_type):
+    """
+    Imports the SQL driver module of the given SQL type only
+
+    @param sql_type:
+        'mysql' or 'sqlite'
+    """
+    # pylint: disable=global-statement,import-outside-toplevel,redefined-outer-name
+    global MySQLdb
+    global sqlite3
+    try:
+        if sql_type == 'mysql':
+            import MySQLdb
+        else:
+            import sqlite3
+    except ImportError as err:
+        module_import_error(err)
+
 class LogLevel:
     """
     Log levels
@@ -386,25 +553,88 @@ def debug_level():
     global ARGS         # pylint: disable=global-statement
     return ARGS.debug if ARGS.debug is not None else LogLevel.ALWAYS
 
-def log(loglevel, msg):
+class LogFileHandler(logging.Handler):
+    """
+    Logging handler appending records to the logfile,
+    the filename may contain strftime() format codes
+    """
+    def __init__(self, filename):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        # the file is kept open until the formatted filename changes
+        self.logfile = None
+        self.logfile_name = None
+
+    def emit(self, record):
+        try:
+            filename = str(time.strftime(self.filename, time.localtime(record.created)))
+            if filename != self.logfile_name:
+                self.close_logfile()
+                self.logfile = open(filename, "a", buffering=1)
+                self.logfile_name = filename
+            self.logfile.write(self.format(record)+'\n')
+        except Exception:   # pylint: disable=broad-except
+            self.handleError(record)
+
+    def close_logfile(self):
+        """
+        Close the current logfile if open
+        """
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
+            self.logfile_name = None
+
+    def close(self):
+        self.acquire()
+        try:
+            self.close_logfile()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+def log_start():
+    """
+    Start the log listener thread
+
+    log() only queues the messages, the listener thread
+    writes them to stdout and optional logfile
+    """
+    # pylint: disable=global-statement
+    global ARGS
+    global LOG_LISTENER
+    global VERBOSE_LEVEL
+    global DEBUG_LEVEL
+    # pylint: enable=global-statement
+    VERBOSE_LEVEL = verbose_level()
+    DEBUG_LEVEL = debug_level()
+    formatter = logging.Formatter('%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if ARGS.logfile is not None:
+        handlers.append(LogFileHandler(ARGS.logfile))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
+    LOG_LISTENER = logging.handlers.QueueListener(log_queue, *handlers)
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop)
+
+def log(loglevel, msg, *args):
     """
     Writes a message to stdout and optional logfile
     if given loglevel is >= verbose_level()
 
-    @param msg: message to output
+    @param msg: message to output, format string if args are given
+    @param args: optional msg format arguments,
+                 only formatted if the message is output
     """
-    if verbose_level() >= loglevel:
-        global ARGS   # pylint: disable=global-statement
-        strtime = str(time.strftime("%Y-%m-%d %H:%M:%S"))
-        # print strtime+': '+msg
-        if ARGS.logfile is not None:
-            filename = str(time.strftime(ARGS.logfile, time.localtime()))
-            logfile = open(filename, "a")
-            logfile.write(strtime+': '+msg+'\n')
-            logfile.close()
-        print(strtime+': '+msg)
+    if VERBOSE_LEVEL >= loglevel:
+        LOGGER.info(msg.format(*args) if args else msg)
 
-def debuglog(dbglevel, msg):
+def debuglog(dbglevel, msg, *args):
     """
     Writes a message to stdout and optional logfile
     if given dbglevel is >= debug_level()
@@ -415,10 +645,12 @@ def debuglog(dbglevel, msg):
         if -d is given one time and dbglevel is 1, then msg is output
         if -d is given one time and dbglevel is 2, then msg will not output
         if -d is given two times and dbglevel is 2, then msg will output
-    @param msg: message to output
+    @param msg: message to output, format string if args are given
+    @param args: optional msg format arguments,
+                 only formatted if the message is output
     """
-    if debug_level() > dbglevel:
-        log(LogLevel.ALWAYS, msg)
+    if DEBUG_LEVEL > dbglevel:
+        log(LogLevel.ALWAYS, msg, *args)
 
 def issocket(name):
     """
@@ -429,18 +661,108 @@ def issocket(name):
 
     return True if name is a socket name
     """
-    nametype = re.search(r'^(\/\S*)*', name)
-    return nametype is not None and nametype.group(0) == name
+    return SOCKET_NAME.fullmatch(name) is not None
+
+class TopicFilter:
+    """
+    MQTT topic filter list, matches topics against filters
+    including wildcards '+' and '#' using a trie of topic levels
+    """
+    # trie node key marking the end of a filter
+    END = None
+
+    def __init__(self, filters):
+        # filters without wildcards are matched by set lookup
+        self.exact = frozenset(topic_filter for topic_filter in filters if not self.has_wildcard(topic_filter))
+        self.root = {}
+        for topic_filter in filters:
+            if topic_filter in self.exact:
+                continue
+            node = self.root
+            for level in topic_filter.split('/'):
+                node = node.setdefault(level, {})
+            node[self.END] = True
+
+    @staticmethod
+    def has_wildcard(topic_filter):
+        """
+        Check if topic filter contains a wildcard level
+
+        @param topic_filter:
+            topic filter to check
+
+        @return:
+            True if filter contains a '+' or '#' level
+        """
+        return any(level in ('+', '#') for level in topic_filter.split('/'))
+
+    def match(self, topic):
+        """
+        Check if topic matches any filter
+
+        @param topic:
+            topic name to check
+
+        @return:
+            True if topic matches
+        """
+        if topic in self.exact:
+            return True
+        if len(self.root) == 0:
+            return False
+        nodes = [self.root]
+        # wildcards on first level do not match topics beginning with '$'
+        wildcards = not topic.startswith('$')
+        for level in topic.split('/'):
+            next_nodes = []
+            for node in nodes:
+                if wildcards:
+                    if self.END in node.get('#', ()):
+                        return True
+                    child = node.get('+')
+                    if child is not None:
+                        next_nodes.append(child)
+                child = node.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if len(next_nodes) == 0:
+                return False
+            nodes = next_nodes
+            wildcards = True
+        # 'a/#' also matches the parent level 'a'
+        for node in nodes:
+            if self.END in node or self.END in node.get('#', ()):
+                return True
+        return False
 
 class Mqtt2Sql:
     """
     MQTT to SQL handling class
     """
-    def __init__(self, args):
+    # fixed attribute set, faster attribute access within message callbacks
+    __slots__ = (
+        'exit_code', 'exit_message', 'exit_event', 'args_', 'signal_handler',
+        'connected', 'connect_rc', 'reconnect_delay',
+        'mqtt_url', 'scheme', 'mqtt_host', 'mqtt_port', 'mqtt_username', 'mqtt_password',
+        'mqtt_topic', 'mqtt_exclude_topic', 'mqtt_subscriptions', 'mqtt_exclude',
+        'cafile', 'certfile', 'keyfile', 'insecure', 'mqtt_keepalive', 'connect_timeout',
+        'mqttc', 'userdata',
+        'sql_timezone', 'sql_tzinfo', 'timestamp_sec', 'timestamp_str',
+        'db_connection', 'db_cursor', 'sql_typestr', 'sql_open', 'sql_execute',
+        'sql_connection', 'sql_insert', 'sql_update', 'sql_error', 'sql_error_check',
+        'write2sql_stop', 'write2sql_thread', 'sql_queue', 'sql_last_written', 'sql_unwritten',
+        'ingested', 'written', 'coalesced', 'dropped', 'failed', 'dropped_logged', 'dropped_logtime'
+    )
+
+    def __init__(self, args, signal_handler):
         self.exit_code = ExitCode.OK
+        self.exit_message = None
+        self.exit_event = Event()
         self.args_ = args
+        self.signal_handler = signal_handler
         self.connected = False
         self.connect_rc = 0
+        self.reconnect_delay = MQTT_RECONNECT_DELAY_MIN
         self.mqtt_url = args.mqtt_url
         self.mqtt_host = args.mqtt_host
         self.mqtt_port = args.mqtt_port
@@ -455,94 +777,208 @@ class Mqtt2Sql:
         self.keyfile = args.mqtt_keyfile
         self.insecure = args.mqtt_insecure
         self.sql_timezone = args.sql_timezone
+        self.sql_tzinfo = zoneinfo.ZoneInfo(args.sql_timezone)
+        # formatted timestamp cache, timestamps have a resolution of 1 sec
+        self.timestamp_sec = None
+        self.timestamp_str = None
         self.write2sql_thread = None
-        self.pool_sqlconnections = BoundedSemaphore(value=args.sql_max_connection)
+        self.db_connection = None
+        self.db_cursor = None
+        self.sql_typestr = SQLTYPES[args.sql_type]
+        # parameterized SQL statements and SQL type handler, set once
+        if args.sql_type == 'mysql':
+            self.sql_open = self.sql_open_mysql
+            self.sql_execute = self.sql_execute_mysql
+            self.sql_error = MySQLdb.Error     # pylint: disable=no-member
+            self.sql_error_check = self.sql_error_check_mysql
+            # MySQLdb.connect() arguments
+            self.sql_connection = {'db': args.sql_db}
+            if issocket(args.sql_host):
+                self.sql_connection['unix_socket'] = args.sql_host
+            else:
+                self.sql_connection['host'] = args.sql_host
+                if args.sql_port is not None:
+                    self.sql_connection['port'] = args.sql_port
+            if args.sql_username is not None:
+                self.sql_connection['user'] = args.sql_username
+            if args.sql_password is not None:
+                self.sql_connection['passwd'] = args.sql_password
+            self.sql_insert = "INSERT INTO `{0}` (`ts`,`topic`,`value`,`qos`,`retain`) \
+                VALUES (%s,%s,%s,%s,%s) \
+                ON DUPLICATE KEY UPDATE `ts`=VALUES(`ts`),`value`=VALUES(`value`),`qos`=VALUES(`qos`),`retain`=VALUES(`retain`)"\
+                .format(args.sql_table)
+            self.sql_update = None
+        else:
+            self.sql_open = self.sql_open_sqlite
+            self.sql_execute = self.sql_execute_sqlite
+            self.sql_error = sqlite3.Error
+            self.sql_error_check = self.sql_error_check_sqlite
+            if sqlite3.sqlite_version_info >= (3, 24, 0):
+                # UPSERT within one statement
+                self.sql_insert = "INSERT INTO `{0}` \
+                    (ts,topic,value,qos,retain) \
+                    VALUES(?,?,?,?,?) \
+                    ON CONFLICT(topic) DO UPDATE SET \
+                        ts=excluded.ts, \
+                        value=excluded.value, \
+                        qos=excluded.qos, \
+                        retain=excluded.retain"\
+                    .format(args.sql_table)
+                self.sql_update = None
+            else:
+                self.sql_insert = "INSERT OR IGNORE INTO `{0}` \
+                    (ts,topic,value,qos,retain) \
+                    VALUES(?,?,?,?,?)"\
+                    .format(args.sql_table)
+                self.sql_update = "UPDATE `{0}` \
+                    SET ts=?, \
+                        value=?, \
+                        qos=?, \
+                        retain=? \
+                    WHERE topic=?"\
+                    .format(args.sql_table)
+        self.write2sql_stop = Event()
+        self.sql_queue = queue.Queue(maxsize=args.sql_queue_size)
+        # topic: (payload, monotonic time) of the last written message,
+        # least recently received topics first
+        self.sql_last_written = OrderedDict() if args.sql_write_on_change else None
+        # topics of messages the writer gave up, removed from
+        # sql_last_written by the MQTT thread
+        self.sql_unwritten = deque()
         self.userdata = {
-            'haveresponse' : False,
             'starttime'    : time.time()
         }
+        # message counters, each one is only written by a single thread,
+        # dropped_logged and dropped_logtime by the writer
+        self.ingested = 0
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.dropped_logged = 0
+        self.dropped_logtime = 0
         if self.mqtt_url is not None:
             self.get_mqtt_parts()
+        # subscription topics are the same on each (re)connect
+        self.mqtt_subscriptions = self.mqtt_topic if isinstance(self.mqtt_topic, (list, tuple)) else [self.mqtt_topic]
+        if self.args_.mqtt_shared_group is not None:
+            self.mqtt_subscriptions = ['$share/{}/{}'.format(self.args_.mqtt_shared_group, topic) for topic in self.mqtt_subscriptions]
+        self.mqtt_subscriptions = [(topic, self.args_.mqtt_qos) for topic in self.mqtt_subscriptions]
+        self.mqtt_exclude = None
+        if self.mqtt_exclude_topic:
+            self.mqtt_exclude = TopicFilter(self.mqtt_exclude_topic if isinstance(self.mqtt_exclude_topic, (list, tuple)) else [self.mqtt_exclude_topic])
         self.verbose_print()
         self.mqttc, ret = self.mqtt_connect()
         if ret != ExitCode.OK:
-            SignalHandler.exitus(ret, '{}:{} failed - [{}] {}'.format(self.mqtt_host, self.mqtt_port, ret, mqtt.error_string(ret)))
+            self.signal_handler.exitus(ExitCode.MQTT_CONNECTION_ERROR, '{}:{} failed - [{}] {}'.format(self.mqtt_host, self.mqtt_port, ret, mqtt.error_string(ret)))
 
-    def write2sql(self, message):
+    def exit_request(self, exit_code, message=None):
         """
-        Called as thread from mqtt backlog handler when a message has been
-        received on a topic that the client subscribes to.
+        Request program exit from any thread,
+        the main loop is woken up and exits with exit_code
 
+        @param exit_code:
+            the exit status program returns to caller
         @param message:
-            an instance of MQTTMessage.
-            This is a class with members topic, payload, qos, retain.
+            the message logged before exit
         """
-        def sql_execute_exception(retry_condition, error_str):
-            """
-            handling local SQL exceptions
+        self.exit_code = exit_code
+        self.exit_message = message
+        self.exit_event.set()
+        self.write2sql_stop.set()
+        self.signal_handler.wakeup()
 
-            @param retry_condition:
-                condition for retry transaction
-                if True delay process and return
-                if False rollback transaction and return
-            @param error_str:
-                error string to output
-            """
-            global SQLTYPES # pylint: disable=global-statement
-            nonlocal db_connection, sql, transaction_retry
-
-            typestr = SQLTYPES[self.args_.sql_type]
-
-            transaction_delay = random()
-            transaction_delay *= 2
-            debuglog(1, "[{}]: {} transaction ERROR: {}, retry={}, delay={}".format(get_ident(), typestr, error_str, transaction_retry, transaction_delay))
-            if retry_condition:
-                transaction_retry -= 1
-                log(LogLevel.NOTICE, "SQL transaction WARNING: {} - try retry".format(error_str))
-                time.sleep(transaction_delay)
-            else:
-                log(LogLevel.NOTICE, "{} transaction ERROR {}".format(typestr, error_str))
-                log(LogLevel.ERROR, "{} give up: {}".format(typestr, sql))
-                # try rollback in case there is any error
-                try:
-                    db_connection.rollback()
-                    transaction_retry = 0
-                except Exception as err:    # pylint: disable=broad-except
-                    pass
+    def write2sql_loop(self):
+        """
+        SQL writer thread:
+        collects queued messages into batches and writes them to the database
+        until stop is requested and the queue is empty
+        """
+        while not (self.write2sql_stop.is_set() and self.sql_queue.empty()):
+            batch = self.sql_batch()
+            if len(batch) > 0:
+                if self.write2sql(batch):
+                    self.written += len(batch)
+                else:
+                    self.failed += len(batch)
+                    if self.sql_last_written is not None:
+                        self.sql_unwritten.extend(item[1] for item in batch)
+            self.log_dropped()
+        self.log_dropped(force=True)
+        self.sql_disconnect()
+
+    def log_dropped(self, force=False):
+        """
+        Logs the number of messages dropped due to a full SQL queue
+        since the last call, at most once per second
 
-        # pylint: disable=global-statement
-        global SQLTYPES
-        # pylint: enable=global-statement
+        @param force:
+            log regardless of the time since the last output
+        """
+        dropped = self.dropped
+        if dropped == self.dropped_logged:
+            return
+        now = time.monotonic()
+        if force or now - self.dropped_logtime >= 1.0:
+            log(LogLevel.NOTICE, "SQL queue full - dropped {} messages ({} total)", dropped - self.dropped_logged, dropped)
+            self.dropped_logged = dropped
+            self.dropped_logtime = now
+
+    def sql_batch(self):
+        """
+        Collects queued messages until the batch is full or the batch
+        delay after the first message elapsed
 
-        if self.exit_code != ExitCode.OK:
-            sys.exit(0)
+        @return:
+            list of (timestamp, topic, payload, qos, retain) tuples, may be empty
+        """
+        batch = []
+        # local names within the per message loop
+        get = self.sql_queue.get
+        append = batch.append
+        monotonic = time.monotonic
+        batch_size = self.args_.sql_batch_size
+        try:
+            item = get(timeout=1.0)
+        except queue.Empty:
+            return batch
+        deadline = monotonic() + self.args_.sql_batch_delay
+        # None is queued on stop request to end waiting
+        while item is not None:
+            append(item)
+            timeout = deadline - monotonic()
+            if len(batch) >= batch_size or timeout <= 0:
+                break
+            try:
+                item = get(timeout=timeout)
+            except queue.Empty:
+                break
+        if self.args_.sql_coalesce:
+            # write only the latest message of each topic
+            latest = {}
+            for item in batch:
+                latest[item[1]] = item
+            debuglog(2, "coalesce {} messages to {} topics", len(batch), len(latest))
+            self.coalesced += len(batch) - len(latest)
+            batch = list(latest.values())
+        return batch
+
+    def sql_connect(self):
+        """
+        Connects to the database, retries on error
 
-        timestamp = datetime.datetime.now(tz=zoneinfo.ZoneInfo(self.args_.sql_timezone)).strftime("%Y-%m-%d %H:%M:%S")
+        @return:
+            database connection or None on give up or exit request
+        """
         connection_retry = self.args_.sql_connection_retry
         connection_delay = self.args_.sql_connection_retry_start_delay
-        connection_delay_base = self.args_.sql_connection_retry_start_delay
-        debuglog(3, "SQL type is '{}'".format(SQLTYPES[self.args_.sql_type]))
+        debuglog(3, "SQL type is '{}'", self.sql_typestr)
         db_connection = None
         while connection_retry > 0:
-            if self.exit_code != ExitCode.OK:
-                sys.exit(0)
+            if self.exit_event.is_set():
+                return None
             try:
-                if self.args_.sql_type == 'mysql':
-                    connection = {'db': self.args_.sql_db}
-                    if issocket(self.args_.sql_host):
-                        connection['unix_socket'] = self.args_.sql_host
-                    else:
-                        connection['host'] = self.args_.sql_host
-                        if self.args_.sql_port is not None:
-                            connection['port'] = self.args_.sql_port
-                    if self.args_.sql_username is not None:
-                        connection['user'] = self.args_.sql_username
-                    if self.args_.sql_password is not None:
-                        connection['passwd'] = self.args_.sql_password
-                    db_connection = MySQLdb.connect(**connection)
-
-                elif self.args_.sql_type == 'sqlite':
-                    db_connection = sqlite3.connect(self.args_.sql_db)
+                db_connection = self.sql_open()
                 connection_retry = 0
 
             except Exception as err:    # pylint: disable=broad-except
@@ -553,126 +989,251 @@ class Mqtt2Sql:
                     error_code = 0
                 if error_code == 2005:
                     connection_retry = 0
-                debuglog(1, "[{}]: SQL connection ERROR: {}, retry={}, delay={}".format(get_ident(), SQLTYPES[self.args_.sql_type], connection_retry, connection_delay))
+                debuglog(1, "[{}]: SQL connection ERROR: {}, retry={}, delay={}", get_ident(), self.sql_typestr, connection_retry, connection_delay)
                 if connection_retry > 0:
-                    log(LogLevel.NOTICE, "SQL connection WARNING: {} - try retry".format(err))
-                    time.sleep(connection_delay)
-                    connection_delay += connection_delay_base
+                    log(LogLevel.NOTICE, "SQL connection WARNING: {} - try retry", err)
+                    self.write2sql_stop.wait(connection_delay)
+                    connection_delay = min(connection_delay * 2, SQL_CONNECTION_RETRY_DELAY_MAX)
                 else:
-                    log(LogLevel.NOTICE, "SQL connection ERROR: {} - give up".format(err))
-                    os.kill(os.getpid(), signal.SIGTERM)
-                    SignalHandler.exitus(ExitCode.SQL_CONNECTION_ERROR, "SQL connection ERROR: {} - give up".format(err))
+                    log(LogLevel.NOTICE, "SQL connection ERROR: {} - give up", err)
+                    self.exit_request(ExitCode.SQL_CONNECTION_ERROR, "SQL connection ERROR: {} - give up".format(err))
+                    return None
 
-        transaction_retry = self.args_.sql_transaction_retry
-        while transaction_retry > 0:
-            if self.exit_code != ExitCode.OK:
-                sys.exit(0)
-            cursor = db_connection.cursor()
+        return db_connection
+
+    def sql_open_mysql(self):
+        """
+        Opens a MySQL database connection
+
+        @return:
+            database connection
+        """
+        db_connection = MySQLdb.connect(**self.sql_connection)
+        # session setting is kept for the connection lifetime
+        sql = "SET SESSION time_zone = '" + self.args_.sql_timezone + "'"
+        debuglog(4, "SQL exec: '{}'", sql)
+        cursor = db_connection.cursor()
+        cursor.execute(sql)
+        cursor.close()
+        return db_connection
+
+    def sql_open_sqlite(self):
+        """
+        Opens a SQLite database connection
+
+        @return:
+            database connection
+        """
+        # take the write lock at transaction start, a batch
+        # does not fail on lock upgrade halfway through
+        db_connection = sqlite3.connect(self.args_.sql_db, timeout=SQLITE_BUSY_TIMEOUT, isolation_level='IMMEDIATE')
+        # WAL with synchronous NORMAL syncs on checkpoint instead of each
+        # commit and does not block readers while writing
+        for sql in ("PRAGMA journal_mode={}".format(self.args_.sql_journal_mode),
+                    "PRAGMA synchronous={}".format(self.args_.sql_synchronous),
+                    "PRAGMA cache_size=-{}".format(SQLITE_CACHE_SIZE)):
+            debuglog(4, "SQL exec: '{}'", sql)
+            db_connection.execute(sql)
+        return db_connection
+
+    def sql_execute_mysql(self, cursor, values):
+        """
+        Executes the MySQL statements for a batch
+
+        @param cursor:
+            database cursor
+        @param values:
+            list of (timestamp, topic, payload, qos, retain) tuples
+
+        @return:
+            True on success, False if exit was requested
+        """
+        # executemany() sends this as one multi-row statement
+        debuglog(4, "SQL exec: '{}' x {}", self.sql_insert, len(values))
+        cursor.executemany(self.sql_insert, values)
+        return True
+
+    def sql_execute_sqlite(self, cursor, values):
+        """
+        Executes the SQLite statements for a batch
+
+        @param cursor:
+            database cursor
+        @param values:
+            list of (timestamp, topic, payload, qos, retain) tuples
+
+        @return:
+            True on success, False if exit was requested
+        """
+        debuglog(4, "SQL exec: '{}' x {}", self.sql_insert, len(values))
+        try:
+            cursor.executemany(self.sql_insert, values)
+        except sqlite3.OperationalError as err:
+            if self.sql_error_check_sqlite(err)[0]:
+                raise
+            self.exit_request(ExitCode.SQL_CONNECTION_ERROR, "SQL ERROR: {}".format(err))
+            return False
+        if self.sql_update is None:
+            return True
+        # SQLite < 3.24 has no UPSERT, update existing topics separately,
+        # topic is the first parameter of INSERT but the last of UPDATE
+        values = [(timestamp, payload, qos, retain, topic) for timestamp, topic, payload, qos, retain in values]
+        debuglog(4, "SQL exec: '{}' x {}", self.sql_update, len(values))
+        try:
+            cursor.executemany(self.sql_update, values)
+        except sqlite3.OperationalError as err:
+            if self.sql_error_check_sqlite(err)[0]:
+                raise
+            self.exit_request(ExitCode.SQL_CONNECTION_ERROR, "SQL ERROR: {}".format(err))
+            return False
+        return True
+
+    def sql_error_check_mysql(self, err):
+        """
+        Checks a MySQL error, disconnects if the connection is lost
+
+        @param err:
+            MySQLdb.Error exception
+
+        @return:
+            (retry, error string) tuple
+        """
+        code = err.args[0] if len(err.args) > 0 else None
+        if code in MYSQL_RECONNECT_ERRORS:
+            # reconnect on retry
+            self.sql_disconnect()
+        return code in MYSQL_RETRY_ERRORS, "[{}]: {}".format(code, err.args[1] if len(err.args) > 1 else err)
+
+    def sql_error_check_sqlite(self, err):  # pylint: disable=no-self-use
+        """
+        Checks a SQLite error
+
+        @param err:
+            sqlite3.Error exception
+
+        @return:
+            (retry, error string) tuple
+        """
+        # SQLITE_BUSY 'database is locked' and SQLITE_LOCKED 'database table is locked'
+        return isinstance(err, sqlite3.OperationalError) and 'locked' in str(err).lower(), str(err)
+
+    def sql_disconnect(self):
+        """
+        Closes the database connection if any
+        """
+        if self.db_cursor is not None:
+            try:
+                self.db_cursor.close()
+            except Exception:   # pylint: disable=broad-except
+                pass
+            self.db_cursor = None
+        if self.db_connection is not None:
             try:
-                # INSERT/UPDATE record
-                if self.args_.sql_type == 'mysql':
-                    sql = "SET SESSION time_zone = '" + self.args_.sql_timezone + "'"
-                    debuglog(4, "SQL exec: '{}'".format(sql))
-                    cursor.execute(sql)
-                    sql = "INSERT INTO `{0}` \
-                        SET `ts`='{1}',`topic`='{2}',`value`=x'{3}',`qos`='{4}',`retain`='{5}' \
-                        ON DUPLICATE KEY UPDATE `ts`='{1}',`value`=x'{3}',`qos`='{4}',`retain`='{5}'"\
-                        .format(
-                            self.args_.sql_table,
-                            timestamp,
-                            message.topic,
-                            message.payload.hex(),
-                            message.qos,
-                            message.retain
-                        )
-                    debuglog(4, "SQL exec: '{}'".format(sql))
-                    cursor.execute(sql)
-                elif self.args_.sql_type == 'sqlite':
-                    sql = "INSERT OR IGNORE INTO `{0}` \
-                            (ts,topic,value,qos,retain) \
-                            VALUES('{1}','{2}',x'{3}','{4}','{5}')"\
-                        .format(
-                            self.args_.sql_table,
-                            timestamp,
-                            message.topic,
-                            message.payload.hex(),
-                            message.qos,
-                            message.retain
-                        )
-                    debuglog(4, "SQL exec: '{}'".format(sql))
-                    try:
-                        cursor.execute(sql)
-                    except sqlite3.OperationalError as err:
-                        self.exit_code = ExitCode.SQL_CONNECTION_ERROR
-                        sys.exit(self.exit_code)
-                    sql = "UPDATE `{0}` \
-                            SET ts='{1}', \
-                                value=x'{3}', \
-                                qos='{4}', \
-                                retain='{5}' \
-                            WHERE topic='{2}'"\
-                        .format(
-                            self.args_.sql_table,
-                            timestamp,
-                            message.topic,
-                            message.payload.hex(),
-                            message.qos,
-                            message.retain
-                        )
-                    debuglog(4, "SQL exec: '{}'".format(sql))
-                    try:
-                        cursor.execute(sql)
-                    except sqlite3.OperationalError as err:
-                        self.exit_code = ExitCode.SQL_CONNECTION_ERROR
-                        sys.exit(self.exit_code)
-
-                db_connection.commit()
-                debuglog(1, "[{}]: SQL success: table='{}', topic='{}', value='{}', qos='{}', retain='{}'".format(get_ident(), self.args_.sql_table, message.topic, message.payload, message.qos, message.retain))
+                self.db_connection.close()
+            except Exception:   # pylint: disable=broad-except
+                pass
+            self.db_connection = None
+
+    def write2sql(self, batch):
+        """
+        Writes a batch of messages within one transaction
+
+        @param batch:
+            list of (timestamp, topic, payload, qos, retain) tuples
+        @return:
+            True if the batch was committed, False otherwise
+        """
+        def sql_execute_exception(retry_condition, error_str):
+            """
+            handling local SQL exceptions
+
+            @param retry_condition:
+                condition for retry transaction
+                if True rollback transaction, delay process and return
+                if False rollback transaction and return
+            @param error_str:
+                error string to output
+            """
+            nonlocal transaction_retry
+
+            # try rollback in case there is any error,
+            # a retry writes the whole batch again
+            try:
+                self.db_connection.rollback()
+            except Exception as err:    # pylint: disable=broad-except
+                pass
+            if retry_condition:
+                # exponential backoff with jitter
+                transaction_delay = min(SQL_TRANSACTION_RETRY_DELAY_MIN * 2 ** (self.args_.sql_transaction_retry - transaction_retry), SQL_TRANSACTION_RETRY_DELAY_MAX) * (1 + random())
+                debuglog(1, "[{}]: {} transaction ERROR: {}, retry={}, delay={}", get_ident(), self.sql_typestr, error_str, transaction_retry, transaction_delay)
+                transaction_retry -= 1
+                log(LogLevel.NOTICE, "SQL transaction WARNING: {} - try retry", error_str)
+                self.write2sql_stop.wait(transaction_delay)
+            else:
+                debuglog(1, "[{}]: {} transaction ERROR: {}, retry={}", get_ident(), self.sql_typestr, error_str, transaction_retry)
+                log(LogLevel.NOTICE, "{} transaction ERROR {}", self.sql_typestr, error_str)
+                log(LogLevel.ERROR, "{} give up: {} messages '{}'", self.sql_typestr, len(batch), self.sql_insert)
                 transaction_retry = 0
 
-            except MySQLdb.Error as err:    # pylint: disable=no-member
-                sql_execute_exception(
-                    err.args[0] in [1040, 1205, 1213],
-                    "[{}]: {}".format(err.args[0], err.args[1])
-                    )
+        if self.exit_event.is_set():
+            return False
+
+        transaction_retry = self.args_.sql_transaction_retry
+        while transaction_retry > 0:
+            if self.exit_event.is_set():
+                return False
+            # the connection and its cursor are kept open across batches
+            if self.db_connection is None:
+                self.db_connection = self.sql_connect()
+                if self.db_connection is None:
+                    return False
+                self.db_cursor = self.db_connection.cursor()
+            try:
+                # INSERT/UPDATE records
+                # batch items are the statement values
+                if not self.sql_execute(self.db_cursor, batch):
+                    return False
 
-            except sqlite3.Error as err:
-                sql_execute_exception(
-                    "database is locked" in str(err).lower(),
-                    err
-                    )
+                self.db_connection.commit()
+                if DEBUG_LEVEL > 1:
+                    for timestamp, topic, payload, qos, retain in batch:
+                        debuglog(1, "[{}]: SQL success: table='{}', topic='{}', value='{}', qos='{}', retain='{}'", get_ident(), self.args_.sql_table, topic, payload, qos, retain)
+                return True
 
-            finally:
-                cursor.close()
-                db_connection.close()
-                self.pool_sqlconnections.release()
-                return
+            except self.sql_error as err:
+                # driver specific error class, MySQLdb may not be installed
+                sql_execute_exception(*self.sql_error_check(err))
 
-        db_connection.close()
-        self.pool_sqlconnections.release()
+        return False
 
     def verbose_print(self):
         """
         Verbose args
         """
-        log(LogLevel.INFORMATION, '  MQTT server: {}:{} {}{} keepalive {}'.format(self.mqtt_host, self.mqtt_port, 'SSL' if (self.cafile is not None) else '', ' (suppress TLS verification)' if self.insecure else '', self.mqtt_keepalive))
-        log(LogLevel.INFORMATION, '    user:    {}'.format(self.mqtt_username))
-        log(LogLevel.INFORMATION, '    topics:  {}'.format(self.mqtt_topic))
-        log(LogLevel.INFORMATION, '    exclude: {}'.format(self.mqtt_exclude_topic))
-        log(LogLevel.INFORMATION, '  SQL type: {}'.format(SQLTYPES[self.args_.sql_type]))
+        log(LogLevel.INFORMATION, '  MQTT server: {}:{} {}{} keepalive {}', self.mqtt_host, self.mqtt_port, 'SSL' if (self.cafile is not None) else '', ' (suppress TLS verification)' if self.insecure else '', self.mqtt_keepalive)
+        log(LogLevel.INFORMATION, '    protocol: {} qos {}{}', self.args_.mqtt_protocol, self.args_.mqtt_qos, ' shared group {}'.format(self.args_.mqtt_shared_group) if self.args_.mqtt_shared_group is not None else '')
+        log(LogLevel.INFORMATION, '    user:    {}', self.mqtt_username)
+        log(LogLevel.INFORMATION, '    topics:  {}', self.mqtt_topic)
+        log(LogLevel.INFORMATION, '    exclude: {}', self.mqtt_exclude_topic)
+        log(LogLevel.INFORMATION, '  SQL type: {}', self.sql_typestr)
         if issocket(self.args_.sql_host):
-            log(LogLevel.INFORMATION, '    server:  {} [max {} connections]'.format(self.args_.sql_host, self.args_.sql_max_connection))
+            log(LogLevel.INFORMATION, '    server:  {}', self.args_.sql_host)
         else:
-            log(LogLevel.INFORMATION, '    server:   {}:{} [max {} connections]'.format(self.args_.sql_host, self.args_.sql_port, self.args_.sql_max_connection))
-        log(LogLevel.INFORMATION, '    db:       {}'.format(self.args_.sql_db))
-        log(LogLevel.INFORMATION, '    table:    {}'.format(self.args_.sql_table))
-        log(LogLevel.INFORMATION, '    user:     {}'.format(self.args_.sql_username))
-        log(LogLevel.INFORMATION, '    timezone: {}'.format(self.args_.sql_timezone))
+            log(LogLevel.INFORMATION, '    server:   {}:{}', self.args_.sql_host, self.args_.sql_port)
+        log(LogLevel.INFORMATION, '    db:       {}', self.args_.sql_db)
+        log(LogLevel.INFORMATION, '    table:    {}', self.args_.sql_table)
+        log(LogLevel.INFORMATION, '    user:     {}', self.args_.sql_username)
+        log(LogLevel.INFORMATION, '    timezone: {}', self.args_.sql_timezone)
+        log(LogLevel.INFORMATION, '    batch:    {} messages / {} sec{} [queue {}]', self.args_.sql_batch_size, self.args_.sql_batch_delay, ' coalesced' if self.args_.sql_coalesce else '', self.args_.sql_queue_size)
+        if self.args_.sql_type == 'sqlite':
+            log(LogLevel.INFORMATION, '    journal:  {} synchronous {}', self.args_.sql_journal_mode, self.args_.sql_synchronous)
+        if self.args_.sql_write_on_change:
+            log(LogLevel.INFORMATION, '    write:    on change{}'.format(', at least every {} sec'.format(self.args_.sql_write_interval) if self.args_.sql_write_interval > 0 else ''))
         if self.args_.logfile is not None:
-            log(LogLevel.INFORMATION, '  Log file: {}'.format(self.args_.logfile))
+            log(LogLevel.INFORMATION, '  Log file: {}', self.args_.logfile)
         if debug_level() > 0:
-            log(LogLevel.INFORMATION, '  Debug level: {}'.format(debug_level()))
-        log(LogLevel.INFORMATION, '  Verbose level: {}'.format(verbose_level()))
+            log(LogLevel.INFORMATION, '  Debug level: {}', debug_level())
+        log(LogLevel.INFORMATION, '  Verbose level: {}', verbose_level())
 
     def get_mqtt_parts(self):
         """
@@ -717,7 +1278,7 @@ class Mqtt2Sql:
             self.mqtt_password = DEFAULTS['mqtt-password']
         # disable TLS/SSL if module not available
         if not MODULE_SSL_AVAIL and len(self.scheme) and self.scheme[-1] == 's':
-            log(LogLevel.INFORMATION, "Missing python SSL module - MQTT scheme '{}' not possible, use mqtt instead".format(self.scheme))
+            log(LogLevel.INFORMATION, "Missing python SSL module - MQTT scheme '{}' not possible, use mqtt instead", self.scheme)
             self.scheme = 'mqtt'
             self.cafile = None
             self.certfile = None
@@ -729,10 +1290,10 @@ class Mqtt2Sql:
             time.sleep(0.01)
             timeout = timeout -1
 
-        debuglog(2, "MQTT wait_for_connect({}) returns {}".format(connect_timeout, 0 != timeout))
+        debuglog(2, "MQTT wait_for_connect({}) returns {}", connect_timeout, 0 != timeout)
         return 0 != timeout
 
-    def on_connect(self, client, userdata, message, return_code):
+    def on_connect(self, client, userdata, message, return_code, properties=None):
         """
         Called when the broker responds to our connection request.
 
@@ -744,18 +1305,32 @@ class Mqtt2Sql:
             response message sent by the broker
         @param return_code:
             the connection result
+        @param properties:
+            MQTT v5 properties
         """
-        debuglog(1, "MQTT on_connect({},{},{},{}): {}".format(client, userdata, message, return_code, mqtt.error_string(return_code)))
+        debuglog(1, "MQTT on_connect({},{},{},{}): {}", client, userdata, message, return_code, mqtt.error_string(return_code))
         self.connected = mqtt.MQTT_ERR_SUCCESS == return_code
-        self.connect_rc = return_code
+        # MQTT v5 reason code object to int
+        self.connect_rc = getattr(return_code, 'value', return_code)
         if self.connected:
-            if isinstance(self.mqtt_topic, (list, tuple)):
-                for topic in self.mqtt_topic:
-                    debuglog(1, "subscribe to topic {}".format(topic))
-                    client.subscribe(topic, 0)
-            else:
-                debuglog(1, "subscribe to topic {}".format(self.mqtt_topic))
-                client.subscribe(self.mqtt_topic, 0)
+            self.reconnect_delay = MQTT_RECONNECT_DELAY_MIN
+            # all topics within one SUBSCRIBE packet
+            debuglog(1, "subscribe to topics {}", self.mqtt_subscriptions)
+            client.subscribe(self.mqtt_subscriptions)
+
+    def timestamp(self):
+        """
+        Current time as SQL timestamp string in SQL timezone,
+        formatted only once per second
+
+        @return:
+            timestamp string
+        """
+        now = int(time.time())
+        if now != self.timestamp_sec:
+            self.timestamp_str = datetime.datetime.fromtimestamp(now, tz=self.sql_tzinfo).strftime("%Y-%m-%d %H:%M:%S")
+            self.timestamp_sec = now
+        return self.timestamp_str
 
     def on_message(self, client, userdata, message):
         """
@@ -770,18 +1345,49 @@ class Mqtt2Sql:
             an instance of MQTTMessage.
             This is a class with members topic, payload, qos, retain.
         """
-        if self.exit_code != ExitCode.OK:
-            sys.exit(self.exit_code)
-        log(LogLevel.NOTICE, '{} {} [QOS {} Retain {}]'.format(message.topic, message.payload, message.qos, message.retain))
-
-        debuglog(2, "on_message({},{},{})".format(client, userdata, message))
-
-        if self.exit_code == ExitCode.OK:
-            if self.mqtt_exclude_topic is not None and message.topic in self.mqtt_exclude_topic:
-                return
-            self.pool_sqlconnections.acquire()
-            self.write2sql_thread = Thread(target=self.write2sql, args=(message,))
-            self.write2sql_thread.start()
+        if VERBOSE_LEVEL >= LogLevel.NOTICE:
+            # large payloads are shortened, the database gets them complete
+            payload = message.payload
+            if len(payload) > LOG_PAYLOAD_MAX:
+                payload = '{}... ({} bytes)'.format(payload[:LOG_PAYLOAD_MAX], len(payload))
+            log(LogLevel.NOTICE, '{} {} [QOS {} Retain {}]', message.topic, payload, message.qos, message.retain)
+
+        debuglog(2, "on_message({},{},{})", client, userdata, message)
+
+        if self.mqtt_exclude is not None and self.mqtt_exclude.match(message.topic):
+            return
+        if self.sql_last_written is not None:
+            # a lost payload must be written again even if unchanged
+            while self.sql_unwritten:
+                self.sql_last_written.pop(self.sql_unwritten.popleft(), None)
+            now = time.monotonic()
+            last = self.sql_last_written.get(message.topic)
+            if last is not None:
+                self.sql_last_written.move_to_end(message.topic)
+                if last[0] == message.payload \
+                        and (self.args_.sql_write_interval <= 0 or now - last[1] < self.args_.sql_write_interval):
+                    debuglog(2, "skip unchanged topic {}", message.topic)
+                    return
+            self.sql_last_written[message.topic] = (message.payload, now)
+            if len(self.sql_last_written) > SQL_LAST_WRITTEN_MAX:
+                # forget the least recently received topic
+                self.sql_last_written.popitem(last=False)
+        # plain values, the writer does not touch the MQTTMessage object
+        item = (self.timestamp(), message.topic, message.payload, message.qos, message.retain)
+        self.ingested += 1
+        try:
+            self.sql_queue.put_nowait(item)
+        except queue.Full:
+            # drop the oldest message, newer data are more important
+            try:
+                dropped = self.sql_queue.get_nowait()
+                # logged periodically by the writer thread
+                self.dropped += 1
+                if self.sql_last_written is not None and dropped is not None:
+                    self.sql_last_written.pop(dropped[1], None)
+            except queue.Empty:
+                pass
+            self.sql_queue.put_nowait(item)
 
     def on_publish(self, client, userdata, mid):
         """
@@ -801,9 +1407,9 @@ class Mqtt2Sql:
             matches the mid variable returned from the corresponding
             publish() call, to allow outgoing messages to be tracked.
         """
-        debuglog(2, "on_publish({},{},{})".format(client, userdata, mid))
+        debuglog(2, "on_publish({},{},{})", client, userdata, mid)
 
-    def on_subscribe(self, client, userdata, mid, granted_qos):
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
         """
         Called when the broker responds to a subscribe request.
 
@@ -817,8 +1423,10 @@ class Mqtt2Sql:
         @param granted_qos:
             a list of integers that give the QoS level the broker has
             granted for each of the different subscription requests.
+        @param properties:
+            MQTT v5 properties
         """
-        debuglog(2, "on_subscribe({},{},{},{})".format(client, userdata, mid, granted_qos))
+        debuglog(2, "on_subscribe({},{},{},{})", client, userdata, mid, granted_qos)
 
     def on_log(self, client, userdata, level, string):
         """
@@ -835,7 +1443,7 @@ class Mqtt2Sql:
         @param string:
             The message itself
         """
-        debuglog(2, "on_log({},{},{},{})".format(client, userdata, level, string))
+        debuglog(2, "on_log({},{},{},{})", client, userdata, level, string)
 
     def mqtt_connect(self):
         """
@@ -845,13 +1453,16 @@ class Mqtt2Sql:
             mqttc:  MQTT client handle (or None on error)
             ret:    Error code
         """
-        mqttc = mqtt.Client('{}-{:d}'.format(SCRIPTNAME, os.getpid()), clean_session=True, userdata=self.userdata, protocol=mqtt.MQTTv31)
-        if debug_level() > 0:
-            if debug_level() <= 2:
+        protocol = MQTT_PROTOCOLS[self.args_.mqtt_protocol]
+        # MQTT v5 uses clean start on connect instead of clean session
+        mqttc = mqtt.Client(MQTT_CLIENT_ID, clean_session=None if protocol == mqtt.MQTTv5 else True, userdata=self.userdata, protocol=protocol)
+        dbglevel = DEBUG_LEVEL
+        if dbglevel > 0:
+            if dbglevel <= 2:
                 logging.basicConfig(level=logging.WARNING)
-            elif debug_level() <= 3:
+            elif dbglevel <= 3:
                 logging.basicConfig(level=logging.INFO)
-            elif debug_level() >= 4:
+            elif dbglevel >= 4:
                 logging.basicConfig(level=logging.DEBUG)
             logger = logging.getLogger(__name__)
             mqttc.enable_logger(logger)
@@ -859,7 +1470,8 @@ class Mqtt2Sql:
         mqttc.on_message = self.on_message
         mqttc.on_publish = self.on_publish
         mqttc.on_subscribe = self.on_subscribe
-        if debug_level() > 0:
+        # on_log() output needs debug level > 2, don't call it otherwise
+        if dbglevel > 2:
             mqttc.on_log = self.on_log
 
         # cafile controls TLS usage
@@ -874,64 +1486,254 @@ class Mqtt2Sql:
         if self.mqtt_username is not None:
             mqttc.username_pw_set(self.mqtt_username, self.mqtt_password)
 
-        debuglog(1, "mqttc.connect({}, {}, {})".format(self.mqtt_host, self.mqtt_port, self.mqtt_keepalive))
-        try:
-            res = mqttc.connect(self.mqtt_host, self.mqtt_port, self.mqtt_keepalive)
-            debuglog(1, "mqttc.connect() returns {}".format(res))
-        except Exception as err:    # pylint: disable=broad-except,unused-variable
-            return None, ExitCode.MQTT_CONNECTION_ERROR
+        # a transient network error should not end the program,
+        # retry the initial connect once after a short delay
+        ret = ExitCode.MQTT_CONNECTION_ERROR
+        for attempt in range(1, MQTT_CONNECT_ATTEMPTS + 1):
+            debuglog(1, "mqttc.connect({}, {}, {}) attempt {}", self.mqtt_host, self.mqtt_port, self.mqtt_keepalive, attempt)
+            try:
+                res = mqttc.connect(self.mqtt_host, self.mqtt_port, self.mqtt_keepalive)
+                debuglog(1, "mqttc.connect() returns {}", res)
+            except Exception as err:    # pylint: disable=broad-except
+                debuglog(1, "mqttc.connect() failed: {}", err)
+                ret = ExitCode.MQTT_CONNECTION_ERROR
+            else:
+                mqttc.loop_start()      # Start loop to process on_connect()
+                connected = self.wait_for_connect(self.connect_timeout)
+                mqttc.loop_stop()       # Stop loop
+                if connected:
+                    return mqttc, ExitCode.OK
+                ret = self.connect_rc if self.connect_rc != 0 else ExitCode.MQTT_CONNECTION_ERROR
+            if attempt < MQTT_CONNECT_ATTEMPTS:
+                log(LogLevel.NOTICE, 'MQTT connect to {}:{} failed - try retry', self.mqtt_host, self.mqtt_port)
+                self.signal_handler.wait(MQTT_CONNECT_RETRY_DELAY)
+
+        return None, ret
+
+    def mqtt_loop(self, timeout=1.0):
+        """
+        Process MQTT network events,
+        waits within select() until the MQTT socket is ready or timeout
 
-        mqttc.loop_start()      # Start loop to process on_connect()
-        if not self.wait_for_connect(self.connect_timeout):
-            return None, self.connect_rc
-        mqttc.loop_stop()       # Stop loop
+        @param timeout:
+            maximum time in seconds to wait for network traffic
 
-        return mqttc, ExitCode.OK
+        @return:
+            MQTT_ERR_SUCCESS or MQTT error code
+        """
+        sock = self.mqttc.socket()
+        if sock is None:
+            return mqtt.MQTT_ERR_NO_CONN
+        # TLS socket may already hold decrypted data select() can't see
+        if hasattr(sock, 'pending') and sock.pending() > 0:
+            timeout = 0
+        rlist, wlist, _ = select.select([sock, self.signal_handler], [sock] if self.mqttc.want_write() else [], [], timeout)
+        if self.signal_handler in rlist:
+            self.signal_handler.check()
+            if self.exit_event.is_set():
+                self.signal_handler.exitus(self.exit_code, self.exit_message)
+        if sock in rlist or timeout == 0:
+            ret = self.mqttc.loop_read()
+            if ret != mqtt.MQTT_ERR_SUCCESS:
+                return ret
+        if wlist:
+            ret = self.mqttc.loop_write()
+            if ret != mqtt.MQTT_ERR_SUCCESS:
+                return ret
+        return self.mqttc.loop_misc()
 
     def loop_forever(self):
         """
         Main MQTT to SQL loop
         does not return until an error occurs
         """
+        self.write2sql_thread = Thread(target=self.write2sql_loop, name='write2sql')
+        self.write2sql_thread.start()
+        if self.args_.metrics_port is not None:
+            self.metrics_start()
+        try:
+            self.mqtt_forever()
+        finally:
+            # write remaining queued messages before exit
+            self.write2sql_stop.set()
+            try:
+                self.sql_queue.put_nowait(None)
+            except queue.Full:
+                pass
+            # process signals while waiting, a further signal
+            # abandons the messages not yet written
+            while self.write2sql_thread.is_alive():
+                try:
+                    self.signal_handler.wait(0.5)
+                except SystemExit:
+                    self.exit_event.set()
+
+    def metrics_start(self):
+        """
+        Start the metrics HTTP server within a daemon thread
+        """
+        try:
+            server = http.server.ThreadingHTTPServer((self.args_.metrics_host, self.args_.metrics_port), MetricsHandler)
+        except OSError as err:
+            log(LogLevel.ERROR, "Metrics server {}:{} failed - {}", self.args_.metrics_host, self.args_.metrics_port, err)
+            return
+        server.daemon_threads = True
+        server.mqtt2sql = self
+        Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        log(LogLevel.INFORMATION, "Metrics server listen on {}:{}", self.args_.metrics_host, self.args_.metrics_port)
+
+    def metrics(self):
+        """
+        Current counters in Prometheus text format
+
+        @return:
+            metrics text
+        """
+        lines = []
+        for name, mtype, value, text in (
+                ('ingested_total', 'counter', self.ingested, 'MQTT messages queued for SQL'),
+                ('written_total', 'counter', self.written, 'messages written to SQL'),
+                ('coalesced_total', 'counter', self.coalesced, 'messages superseded by a newer one of the same topic within a batch'),
+                ('dropped_total', 'counter', self.dropped, 'messages dropped due to full SQL queue'),
+                ('failed_total', 'counter', self.failed, 'messages given up after SQL errors'),
+                ('inflight', 'gauge', self.sql_queue.qsize(), 'messages waiting in SQL queue')):
+            lines.append('# HELP mqtt2sql_{0} {1}\n# TYPE mqtt2sql_{0} {2}\nmqtt2sql_{0} {3}\n'.format(name, text, mtype, value))
+        return ''.join(lines)
+
+    def mqtt_forever(self):
+        """
+        MQTT network loop
+        does not return until an error occurs
+        """
         while True:
             # Main loop as long as no error occurs
             ret = mqtt.MQTT_ERR_SUCCESS
-            while not self.userdata['haveresponse'] and ret == mqtt.MQTT_ERR_SUCCESS:
+            error_delay = MQTT_LOOP_ERROR_DELAY_MIN
+            while ret == mqtt.MQTT_ERR_SUCCESS:
                 try:
-                    ret = self.mqttc.loop()
+                    ret = self.mqtt_loop()
+                    error_delay = MQTT_LOOP_ERROR_DELAY_MIN
                 except Exception as err:    # pylint: disable=broad-except
-                    log(LogLevel.ERROR, 'ERROR: loop() - {}'.format(err))
-                    time.sleep(0.1)
-                if self.exit_code != ExitCode.OK:
-                    sys.exit(self.exit_code)
-            if ret == mqtt.MQTT_ERR_CONN_LOST:
+                    # log the first error and persistent errors only
+                    if error_delay == MQTT_LOOP_ERROR_DELAY_MIN or error_delay >= MQTT_LOOP_ERROR_DELAY_MAX / 2:
+                        log(LogLevel.ERROR, 'ERROR: loop() - {}', err)
+                    debuglog(1, "MQTT loop error, retry in {:.2f} sec", error_delay)
+                    # exponential backoff on consecutive errors
+                    self.signal_handler.wait(error_delay)
+                    error_delay = min(error_delay * 2, MQTT_LOOP_ERROR_DELAY_MAX)
+                    if self.exit_event.is_set():
+                        self.signal_handler.exitus(self.exit_code, self.exit_message)
+            if ret in MQTT_RECONNECT_ERRORS:
                 # disconnect from server
-                log(LogLevel.NOTICE, 'Remote disconnected from MQTT - [{}] {})'.format(ret, mqtt.error_string(ret)))
+                log(LogLevel.NOTICE, 'Remote disconnected from MQTT - [{}] {})', ret, mqtt.error_string(ret))
+                # exponential backoff with jitter, reset on successful connect
+                delay = self.reconnect_delay * (1 + random())
+                self.reconnect_delay = min(self.reconnect_delay * 2, MQTT_RECONNECT_DELAY_MAX)
+                debuglog(1, "MQTT reconnect in {:.1f} sec", delay)
+                self.signal_handler.wait(delay)
+                if self.exit_event.is_set():
+                    self.signal_handler.exitus(self.exit_code, self.exit_message)
                 try:
                     ret = self.mqttc.reconnect()
-                    log(LogLevel.NOTICE, 'MQTT reconnected - [{}] {}'.format(ret, mqtt.error_string(ret)))
+                    log(LogLevel.NOTICE, 'MQTT reconnected - [{}] {}', ret, mqtt.error_string(ret))
                 except Exception as err:    # pylint: disable=broad-except
-                    SignalHandler.exitus(ExitCode.MQTT_CONNECTION_ERROR, '{}:{} failed - [{}] {}'.format(self.mqtt_host, self.mqtt_port, ret, mqtt.error_string(err)))
+                    log(LogLevel.NOTICE, 'MQTT reconnect {}:{} failed - {}', self.mqtt_host, self.mqtt_port, err)
+                    ret = mqtt.MQTT_ERR_NO_CONN
             else:
-                SignalHandler.exitus(ExitCode.MQTT_CONNECTION_ERROR, '{}:{} failed: - [{}] {}'.format(self.mqtt_host, self.mqtt_port, ret, mqtt.error_string(ret)))
+                self.signal_handler.exitus(ExitCode.MQTT_CONNECTION_ERROR, '{}:{} failed: - [{}] {}'.format(self.mqtt_host, self.mqtt_port, ret, mqtt.error_string(ret)))
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP request handler serving Mqtt2Sql metrics
+    """
+    def do_GET(self):   # pylint: disable=invalid-name
+        """
+        Serve metrics on /metrics
+        """
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.mqtt2sql.metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):   # pylint: disable=redefined-builtin
+        debuglog(2, "metrics {} {}", self.address_string(), format % args)
 
 class SignalHandler:
     """
     Signal Handler Class
     """
+    # signal number to name, built once
+    SIGNAL_NAMES = {int(signal_): signal_.name for signal_ in signal.Signals}
+    __slots__ = ('wakeup_r', 'wakeup_w')
+
     def __init__(self):
-        signal.signal(signal.SIGINT, self._exitus)
-        signal.signal(signal.SIGTERM, self._exitus)
+        # self-pipe: the signal number is written to the pipe by the
+        # interpreter, signals are processed by check() within main loop
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGINT, self._signal)
+        signal.signal(signal.SIGTERM, self._signal)
+
+    def fileno(self):
+        """
+        Signal wakeup file descriptor, allows to use the handler with select()
+        """
+        return self.wakeup_r
+
+    def wakeup(self):
+        """
+        Wake up a select() waiting on this handler without a signal
+        """
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
 
     def _signalname(self, signal_):
-        signals_ = dict((k, v) for v, k in reversed(sorted(signal.__dict__.items())) if v.startswith('SIG') and not v.startswith('SIG_'))
-        return signals_.get(signal_, 'UNKNOWN')
+        return self.SIGNAL_NAMES.get(signal_, 'UNKNOWN')
+
+    def _signal(self, signal_, frame_):   # pylint: disable=unused-argument
+        """
+        signal handler, nothing to do here: the signal
+        is already queued within the wakeup pipe
+        """
 
-    def _exitus(self, signal_, frame_):   # pylint: disable=unused-argument
+    def _exitus(self, signal_):
         """
         local exit with logging
         """
-        self.exitus(signal_, 'signal {}#{}'.format(self._signalname(signal_), signal_))
+        # terminating by signal is a regular exit
+        self.exitus(ExitCode.OK, 'signal {}#{}'.format(self._signalname(signal_), signal_))
+
+    def check(self):
+        """
+        Process pending signals, does not return if a signal was received
+        """
+        try:
+            signals_ = os.read(self.wakeup_r, 64)
+        except BlockingIOError:
+            return
+        for signal_ in signals_:
+            # 0 is a wakeup() without signal
+            if signal_:
+                self._exitus(signal_)
+
+    def wait(self, timeout):
+        """
+        Sleep, but process signals immediately
+
+        @param timeout:
+            time to sleep in seconds
+        """
+        select.select([self], [], [], timeout)
+        self.check()
 
     def exitus(self, status=0, message="end"):
         """
@@ -942,16 +1744,9 @@ class SignalHandler:
         @param message:
             the message logged before exit
         """
-        # pylint: disable=global-statement
-        global SCRIPTNAME
-        global SCRIPTPID
-        global VER
-        # pylint: enable=global-statement
         if message is not None:
             log(LogLevel.INFORMATION, message)
-        log(LogLevel.INFORMATION, '{}[{}] v{} end'.format(SCRIPTNAME, SCRIPTPID, VER))
-        if status in (signal.SIGINT, signal.SIGTERM):
-            status = 0
+        log(LogLevel.INFORMATION, '{} end', SCRIPTPREFIX)
         sys.exit(status)
 
 if __name__ == "__main__":
@@ -960,11 +1755,15 @@ if __name__ == "__main__":
 
     # Parse command line arguments
     ARGS = parseargs()
+    sql_module_import(ARGS.sql_type)
+
+    # Start logging
+    log_start()
 
     # Log program start
-    log(LogLevel.INFORMATION, '{}[{}] v{} start'.format(SCRIPTNAME, SCRIPTPID, VER))
+    log(LogLevel.INFORMATION, '{} start', SCRIPTPREFIX)
 
     # Create class
-    MQTT2SQL = Mqtt2Sql(ARGS)
+    MQTT2SQL = Mqtt2Sql(ARGS, SIG)
     # run loop
     MQTT2SQL.loop_forever()